@@ -1,22 +1,28 @@
 import asyncio
+import hmac
+import json
 import logging
 import random
 import os
 import time
-from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
 from aiogram import Bot, Dispatcher, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.contrib.fsm_storage.redis import RedisStorage2
 from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.storage import BaseStorage
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils import executor
 from aiogram.utils.exceptions import (
     BotBlocked, UserDeactivated, ChatNotFound, RetryAfter,
-    TelegramAPIError, MessageNotModified, MessageToEditNotFound,
-    TerminatedByOtherGetUpdates
+    TelegramAPIError, MessageNotModified, MessageToEditNotFound
 )
 import asyncpg
 from aiohttp import web
+from aiolimiter import AsyncLimiter
 
 # ===== НАСТРОЙКИ =====
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -24,12 +30,36 @@ if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не задан в переменных окружения")
 
 SUPER_ADMINS_STR = os.getenv("SUPER_ADMINS", "")
-SUPER_ADMINS = [int(x.strip()) for x in SUPER_ADMINS_STR.split(",") if x.strip()]
+SUPER_ADMINS = frozenset(int(x.strip()) for x in SUPER_ADMINS_STR.split(",") if x.strip())
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL не задан. Создай PostgreSQL базу в Railway.")
 
+# DB_PGBOUNCER=1, если DATABASE_URL указывает на PgBouncer в режиме transaction:
+# такой пулер не сохраняет именованные prepared statements между транзакциями,
+# поэтому кэш выражений asyncpg нужно отключить
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "").lower() in ("1", "true", "yes")
+
+# Если задан WEBHOOK_HOST (например, https://app.up.railway.app), бот принимает
+# обновления через вебхук на общем aiohttp-сервере, иначе работает через polling
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = f"{WEBHOOK_HOST.rstrip('/')}{WEBHOOK_PATH}" if WEBHOOK_HOST else None
+# Секрет, который Telegram присылает в заголовке X-Telegram-Bot-Api-Secret-Token;
+# запросы на вебхук без него отклоняются (допустимы A-Z, a-z, 0-9, _ и -)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    raise ValueError("WEBHOOK_SECRET не задан, а без него вебхук принимает запросы от кого угодно")
+# WEBHOOK_CHECK_IP=1 дополнительно пускает на вебхук только IP-адреса Telegram
+WEBHOOK_CHECK_IP = os.getenv("WEBHOOK_CHECK_IP", "").lower() in ("1", "true", "yes")
+WEB_PORT = int(os.environ.get("PORT", 8080))
+
+# Если задан REDIS_HOST, состояния FSM хранятся в Redis, иначе – в PostgreSQL
+REDIS_HOST = os.getenv("REDIS_HOST")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+REDIS_PASSWORD = os.getenv("REDIS_PASSWORD")
+
 # Значения по умолчанию для настроек
 DEFAULT_SETTINGS = {
     "random_attack_cost": "0",
@@ -43,6 +73,24 @@ DEFAULT_SETTINGS = {
     "max_theft_amount": "15"
 }
 
+# Колонки с датами, которые раньше хранились как TEXT
+DATE_COLUMNS = [
+    ("users", "joined_date"),
+    ("users", "last_bonus"),
+    ("users", "last_theft_time"),
+    ("giveaways", "end_date"),
+    ("purchases", "purchase_date"),
+    ("admins", "added_date"),
+    ("banned_users", "banned_date"),
+]
+
+# Кэш настроек в памяти: загружается при старте, обновляется через set_setting.
+# Другие воркеры узнают об изменениях через NOTIFY settings_changed, а без LISTEN
+# (DB_PGBOUNCER) перечитывают настройки раз в SETTINGS_CACHE_TTL секунд
+SETTINGS_CACHE: dict[str, str] = {}
+SETTINGS_CHANNEL = "settings_changed"
+SETTINGS_CACHE_TTL = 60
+
 # ===== ИНИЦИАЛИЗАЦИЯ =====
 logging.basicConfig(
     level=logging.INFO,
@@ -52,18 +100,132 @@ logging.basicConfig(
 # Глобальный пул соединений с БД
 db_pool = None
 
+# Фоновые задачи и веб-сервер, которые нужно остановить при завершении
+background_tasks: list[asyncio.Task] = []
+web_runner = None
+
 async def before_start():
-    await bot.delete_webhook(drop_pending_updates=True)
-    logging.info("Webhook удалён, пропущены старые обновления")
+    if WEBHOOK_URL:
+        # Без drop_pending_updates: перезапуск одного воркера не должен терять
+        # обновления, которые ждут обработки остальными
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+        logging.info(f"Webhook установлен: {WEBHOOK_URL}")
+    else:
+        await bot.delete_webhook(drop_pending_updates=True)
+        logging.info("Webhook удалён, пропущены старые обновления")
+
+# ===== ХРАНИЛИЩЕ FSM =====
+# Состояния и данные FSM в таблице fsm_states, чтобы их видели все воркеры
+# и они переживали перезапуск. Работает через общий пул (acquire_conn).
+class PostgresStorage(BaseStorage):
+    async def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        chat, user = self.check_address(chat=chat, user=user)
+        async with acquire_conn() as conn:
+            state = await conn.fetchval(
+                "SELECT state FROM fsm_states WHERE chat_id=$1 AND user_id=$2", int(chat), int(user)
+            )
+        return state or self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        chat, user = self.check_address(chat=chat, user=user)
+        async with acquire_conn() as conn:
+            data = await conn.fetchval(
+                "SELECT data FROM fsm_states WHERE chat_id=$1 AND user_id=$2", int(chat), int(user)
+            )
+        return json.loads(data) if data else (default or {})
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        chat, user = self.check_address(chat=chat, user=user)
+        async with acquire_conn() as conn:
+            await conn.execute(
+                "INSERT INTO fsm_states (chat_id, user_id, state) VALUES ($1, $2, $3) "
+                "ON CONFLICT (chat_id, user_id) DO UPDATE SET state=EXCLUDED.state",
+                int(chat), int(user), self.resolve_state(state)
+            )
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        chat, user = self.check_address(chat=chat, user=user)
+        async with acquire_conn() as conn:
+            await conn.execute(
+                "INSERT INTO fsm_states (chat_id, user_id, data) VALUES ($1, $2, $3::jsonb) "
+                "ON CONFLICT (chat_id, user_id) DO UPDATE SET data=EXCLUDED.data",
+                int(chat), int(user), json.dumps(data or {})
+            )
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        chat, user = self.check_address(chat=chat, user=user)
+        patch = dict(data or {}, **kwargs)
+        async with acquire_conn() as conn:
+            await conn.execute(
+                "INSERT INTO fsm_states (chat_id, user_id, data) VALUES ($1, $2, $3::jsonb) "
+                "ON CONFLICT (chat_id, user_id) DO UPDATE SET data=fsm_states.data || EXCLUDED.data",
+                int(chat), int(user), json.dumps(patch)
+            )
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        chat, user = self.check_address(chat=chat, user=user)
+        async with acquire_conn() as conn:
+            if with_data:
+                await conn.execute("DELETE FROM fsm_states WHERE chat_id=$1 AND user_id=$2", int(chat), int(user))
+            else:
+                await conn.execute(
+                    "UPDATE fsm_states SET state=NULL WHERE chat_id=$1 AND user_id=$2", int(chat), int(user)
+                )
 
 bot = Bot(token=BOT_TOKEN, parse_mode="HTML")
-storage = MemoryStorage()
+if REDIS_HOST:
+    storage = RedisStorage2(REDIS_HOST, REDIS_PORT, db=5, password=REDIS_PASSWORD)
+else:
+    storage = PostgresStorage()
 dp = Dispatcher(bot, storage=storage)
 
+# ===== ОГРАНИЧЕНИЕ ЧАСТОТЫ ОТПРАВКИ =====
+# Telegram допускает ~30 сообщений/сек всего и ~1 сообщение/сек в один чат.
+# Лимиты действуют в пределах одного процесса: при N воркерах суммарно выйдет
+# N * SEND_RATE_LIMIT сообщений/сек, поэтому SEND_RATE_LIMIT нужно делить на число воркеров
+SEND_RATE_LIMIT = int(os.getenv("SEND_RATE_LIMIT", "28"))
+GLOBAL_LIMIT = AsyncLimiter(SEND_RATE_LIMIT, 1)
+PER_CHAT_LIMITS: dict[int, AsyncLimiter] = {}
+PER_CHAT_LAST_USED: dict[int, float] = {}
+PER_CHAT_IDLE_SECONDS = 60
+
+def get_chat_limiter(chat_id: int) -> AsyncLimiter:
+    PER_CHAT_LAST_USED[chat_id] = time.monotonic()
+    return PER_CHAT_LIMITS.setdefault(chat_id, AsyncLimiter(1, 1))
+
+async def cleanup_chat_limiters():
+    while True:
+        await asyncio.sleep(PER_CHAT_IDLE_SECONDS)
+        deadline = time.monotonic() - PER_CHAT_IDLE_SECONDS
+        for chat_id in [c for c, ts in PER_CHAT_LAST_USED.items() if ts < deadline]:
+            PER_CHAT_LAST_USED.pop(chat_id, None)
+            PER_CHAT_LIMITS.pop(chat_id, None)
+
+# После RetryAfter Telegram не принимает сообщения от бота целиком, поэтому
+# пауза общая: все отправки ждут её окончания, прежде чем занять GLOBAL_LIMIT
+FLOOD_PAUSE_UNTIL = 0.0
+
+def pause_sending(timeout: float):
+    global FLOOD_PAUSE_UNTIL
+    FLOOD_PAUSE_UNTIL = max(FLOOD_PAUSE_UNTIL, time.monotonic() + timeout)
+
+async def wait_flood_pause():
+    while (delay := FLOOD_PAUSE_UNTIL - time.monotonic()) > 0:
+        await asyncio.sleep(delay)
+
 # ===== БЕЗОПАСНАЯ ОТПРАВКА СООБЩЕНИЙ =====
 async def safe_send_message(user_id: int, text: str, **kwargs):
     try:
-        await bot.send_message(user_id, text, **kwargs)
+        # Сначала лимит чата, чтобы не занимать общий слот, пока ждём свой
+        await wait_flood_pause()
+        async with get_chat_limiter(user_id), GLOBAL_LIMIT:
+            await bot.send_message(user_id, text, **kwargs)
     except BotBlocked:
         logging.warning(f"Bot blocked by user {user_id}")
     except UserDeactivated:
@@ -72,9 +234,11 @@ async def safe_send_message(user_id: int, text: str, **kwargs):
         logging.warning(f"Chat {user_id} not found")
     except RetryAfter as e:
         logging.warning(f"Flood limit exceeded. Retry after {e.timeout} seconds")
-        await asyncio.sleep(e.timeout)
+        pause_sending(e.timeout)
         try:
-            await bot.send_message(user_id, text, **kwargs)
+            await wait_flood_pause()
+            async with get_chat_limiter(user_id), GLOBAL_LIMIT:
+                await bot.send_message(user_id, text, **kwargs)
         except Exception as ex:
             logging.warning(f"Still failed after retry: {ex}")
     except TelegramAPIError as e:
@@ -88,21 +252,82 @@ def safe_send_message_task(user_id: int, text: str, **kwargs):
 # ===== ПОДКЛЮЧЕНИЕ К POSTGRESQL =====
 async def create_db_pool():
     global db_pool
-    db_pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=10)
+    # Размер пула задаётся через DB_POOL_MIN/DB_POOL_MAX.
+    # Ориентир для сервера: connections = (ядра_CPU * 2) + число_дисков;
+    # суммарный max_size всех воркеров не должен превышать max_connections Postgres.
+    # max_inactive_connection_lifetime=0 не даёт пулу закрывать простаивающие
+    # соединения и проседать ниже min_size.
+    # min_size не может превышать max_size, поэтому при маленьком DB_POOL_MAX
+    # DB_POOL_MIN урезается до него.
+    max_size = int(os.getenv("DB_POOL_MAX", "20"))
+    min_size = min(int(os.getenv("DB_POOL_MIN", "10")), max_size)
+    db_pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=min_size,
+        max_size=max_size,
+        max_inactive_connection_lifetime=0,
+        command_timeout=10,
+        statement_cache_size=0 if DB_PGBOUNCER else 1024,
+        server_settings={'application_name': 'malboro'}
+    )
     logging.info("Подключение к PostgreSQL установлено")
 
+# ===== ОДНО СОЕДИНЕНИЕ НА ОБНОВЛЕНИЕ =====
+# Middleware заводит на каждое обновление держатель соединения. Вложенные вызовы
+# acquire_conn() внутри одного обновления (хелперы внутри блока обработчика)
+# получают то же соединение, а не ждут второе из пула. Как только закрывается
+# внешний блок acquire_conn(), соединение возвращается в пул, чтобы не держать
+# его во время запросов к Telegram. Задачи, запущенные из обработчика
+# (create_task), берут своё.
+update_conn: ContextVar[dict] = ContextVar("update_conn", default=None)
+
+@asynccontextmanager
+async def acquire_conn():
+    holder = update_conn.get()
+    if holder is None or holder['released'] or holder['task'] is not asyncio.current_task():
+        async with db_pool.acquire() as conn:
+            yield conn
+        return
+    if holder['conn'] is None:
+        holder['conn'] = await db_pool.acquire()
+    holder['depth'] += 1
+    try:
+        yield holder['conn']
+    finally:
+        holder['depth'] -= 1
+        if holder['depth'] == 0:
+            conn, holder['conn'] = holder['conn'], None
+            await db_pool.release(conn)
+
+class DBConnectionMiddleware(BaseMiddleware):
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        holder = {'task': asyncio.current_task(), 'conn': None, 'depth': 0, 'released': False}
+        update_conn.set(holder)
+        data['db_conn'] = holder
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        holder = data.get('db_conn')
+        if not holder:
+            return
+        holder['released'] = True
+        if holder['conn'] is not None:
+            conn, holder['conn'] = holder['conn'], None
+            await db_pool.release(conn)
+
+dp.middleware.setup(DBConnectionMiddleware())
+
 async def init_db():
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         # Пользователи
         await conn.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 user_id BIGINT PRIMARY KEY,
                 username TEXT,
                 first_name TEXT,
-                joined_date TEXT,
+                joined_date TIMESTAMPTZ,
                 balance INTEGER DEFAULT 0,
-                last_bonus TEXT,
-                last_theft_time TEXT,
+                last_bonus TIMESTAMPTZ,
+                last_theft_time TIMESTAMPTZ,
                 theft_attempts INTEGER DEFAULT 0,
                 theft_success INTEGER DEFAULT 0,
                 theft_failed INTEGER DEFAULT 0,
@@ -137,7 +362,7 @@ async def init_db():
                 id SERIAL PRIMARY KEY,
                 user_id BIGINT,
                 item_id INTEGER,
-                purchase_date TEXT,
+                purchase_date TIMESTAMPTZ,
                 status TEXT DEFAULT 'pending',
                 admin_comment TEXT
             )
@@ -159,7 +384,7 @@ async def init_db():
                 id SERIAL PRIMARY KEY,
                 prize TEXT,
                 description TEXT,
-                end_date TEXT,
+                end_date TIMESTAMPTZ,
                 media_file_id TEXT,
                 media_type TEXT,
                 status TEXT DEFAULT 'active',
@@ -182,7 +407,7 @@ async def init_db():
             CREATE TABLE IF NOT EXISTS admins (
                 user_id BIGINT PRIMARY KEY,
                 added_by BIGINT,
-                added_date TEXT
+                added_date TIMESTAMPTZ
             )
         ''')
 
@@ -191,11 +416,22 @@ async def init_db():
             CREATE TABLE IF NOT EXISTS banned_users (
                 user_id BIGINT PRIMARY KEY,
                 banned_by BIGINT,
-                banned_date TEXT,
+                banned_date TIMESTAMPTZ,
                 reason TEXT
             )
         ''')
 
+        # Состояния FSM
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                chat_id BIGINT,
+                user_id BIGINT,
+                state TEXT,
+                data JSONB NOT NULL DEFAULT '{}'::jsonb,
+                PRIMARY KEY (chat_id, user_id)
+            )
+        ''')
+
         # Настройки игры
         await conn.execute('''
             CREATE TABLE IF NOT EXISTS settings (
@@ -204,8 +440,22 @@ async def init_db():
             )
         ''')
 
+        # Миграция старых TEXT-колонок с датами на TIMESTAMPTZ
+        for table, column in DATE_COLUMNS:
+            data_type = await conn.fetchval(
+                "SELECT data_type FROM information_schema.columns WHERE table_name=$1 AND column_name=$2",
+                table, column
+            )
+            if data_type == 'text':
+                await conn.execute(
+                    f"ALTER TABLE {table} ALTER COLUMN {column} TYPE TIMESTAMPTZ USING NULLIF({column}, '')::timestamptz"
+                )
+
         # Индексы
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_giveaways_active_end ON giveaways(end_date) WHERE status='active'")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_user ON purchases(user_id, status)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_participants_giveaway ON participants(giveaway_id)")
 
     await create_default_items()
     await init_settings()
@@ -217,86 +467,136 @@ async def create_default_items():
         ("🎁 Конфеты", "Коробка шоколадных конфет", 30, 10),
         ("🎁 Игрушка", "Мягкая игрушка", 70, 5),
     ]
-    async with db_pool.acquire() as conn:
-        for name, desc, price, stock in default_items:
-            exists = await conn.fetchval("SELECT id FROM shop_items WHERE name=$1", name)
-            if not exists:
-                await conn.execute(
-                    "INSERT INTO shop_items (name, description, price, stock) VALUES ($1, $2, $3, $4)",
-                    name, desc, price, stock
-                )
+    names, descs, prices, stocks = (list(col) for col in zip(*default_items))
+    async with acquire_conn() as conn:
+        await conn.execute(
+            """
+            INSERT INTO shop_items (name, description, price, stock)
+            SELECT t.name, t.description, t.price, t.stock
+            FROM unnest($1::text[], $2::text[], $3::int[], $4::int[]) AS t(name, description, price, stock)
+            WHERE NOT EXISTS (SELECT 1 FROM shop_items s WHERE s.name = t.name)
+            """,
+            names, descs, prices, stocks
+        )
 
 async def init_settings():
-    async with db_pool.acquire() as conn:
-        for key, value in DEFAULT_SETTINGS.items():
-            await conn.execute(
-                "INSERT INTO settings (key, value) VALUES ($1, $2) ON CONFLICT (key) DO NOTHING",
-                key, value
-            )
+    async with acquire_conn() as conn:
+        await conn.execute(
+            "INSERT INTO settings (key, value) SELECT * FROM unnest($1::text[], $2::text[]) ON CONFLICT (key) DO NOTHING",
+            list(DEFAULT_SETTINGS.keys()), list(DEFAULT_SETTINGS.values())
+        )
+        await load_settings(conn)
+
+async def load_settings(conn):
+    rows = await conn.fetch("SELECT key, value FROM settings")
+    SETTINGS_CACHE.update({r['key']: r['value'] for r in rows})
 
-async def get_setting(key: str) -> str:
-    async with db_pool.acquire() as conn:
-        value = await conn.fetchval("SELECT value FROM settings WHERE key=$1", key)
-        return value if value else DEFAULT_SETTINGS[key]
+def get_setting(key: str) -> str:
+    value = SETTINGS_CACHE.get(key)
+    return value if value else DEFAULT_SETTINGS[key]
 
 async def set_setting(key: str, value: str):
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         await conn.execute("UPDATE settings SET value=$1 WHERE key=$2", value, key)
+        # Остальные воркеры обновят свой кэш по уведомлению (см. db_listener)
+        await conn.execute("SELECT pg_notify($1, $2)", SETTINGS_CHANNEL, json.dumps({key: value}))
+    SETTINGS_CACHE[key] = value
 
 # ===== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ =====
-async def is_super_admin(user_id: int) -> bool:
+# Тексты горячих запросов собраны в константы, чтобы каждый запрос везде
+# писался одинаково. Подготовленные выражения переиспользует кэш соединения
+# asyncpg (statement_cache_size в create_db_pool), ключ которого — сам текст запроса
+SQL_IS_JUNIOR_ADMIN = "SELECT user_id FROM admins WHERE user_id=$1"
+SQL_IS_BANNED = "SELECT user_id FROM banned_users WHERE user_id=$1"
+SQL_GET_BALANCE = "SELECT balance FROM users WHERE user_id=$1"
+SQL_UPDATE_BALANCE = "UPDATE users SET balance = balance + $1 WHERE user_id=$2 RETURNING balance"
+# Секунды с последней кражи по часам БД (last_theft_time тоже пишется через now())
+SQL_THEFT_ELAPSED = "SELECT EXTRACT(EPOCH FROM now() - last_theft_time)::float8 FROM users WHERE user_id=$1"
+SQL_SPEND_BALANCE = "UPDATE users SET balance = balance - $1 WHERE user_id=$2 AND balance >= $1 RETURNING balance"
+SQL_USER_FLAGS = (
+    "SELECT EXISTS(SELECT 1 FROM admins WHERE user_id=$1) AS a, "
+    "EXISTS(SELECT 1 FROM banned_users WHERE user_id=$1) AS b"
+)
+
+def is_super_admin(user_id: int) -> bool:
     return user_id in SUPER_ADMINS
 
 async def is_junior_admin(user_id: int) -> bool:
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchval("SELECT user_id FROM admins WHERE user_id=$1", user_id)
+    async with acquire_conn() as conn:
+        row = await conn.fetchval(SQL_IS_JUNIOR_ADMIN, user_id)
     return row is not None
 
 async def is_admin(user_id: int) -> bool:
-    return await is_super_admin(user_id) or await is_junior_admin(user_id)
+    return is_super_admin(user_id) or await is_junior_admin(user_id)
 
 async def is_banned(user_id: int) -> bool:
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchval("SELECT user_id FROM banned_users WHERE user_id=$1", user_id)
+    async with acquire_conn() as conn:
+        row = await conn.fetchval(SQL_IS_BANNED, user_id)
     return row is not None
 
+# Возвращает (is_admin, is_banned) за один запрос к БД
+async def get_user_flags(user_id: int) -> tuple[bool, bool]:
+    async with acquire_conn() as conn:
+        row = await conn.fetchrow(SQL_USER_FLAGS, user_id)
+    return is_super_admin(user_id) or row['a'], row['b']
+
+# Кэш списка каналов (обновляется раз в CHANNELS_CACHE_TTL секунд или после изменений)
+CHANNELS_CACHE: list = []
+CHANNELS_CACHE_TS = 0
+CHANNELS_CACHE_TTL = 60
+
+def invalidate_channels_cache():
+    global CHANNELS_CACHE_TS
+    CHANNELS_CACHE_TS = 0
+
 async def get_channels():
-    async with db_pool.acquire() as conn:
+    global CHANNELS_CACHE, CHANNELS_CACHE_TS
+    if time.time() - CHANNELS_CACHE_TS < CHANNELS_CACHE_TTL:
+        return CHANNELS_CACHE
+    async with acquire_conn() as conn:
         rows = await conn.fetch("SELECT chat_id, title, invite_link FROM channels")
-        return [(r['chat_id'], r['title'], r['invite_link']) for r in rows]
+    CHANNELS_CACHE = [(r['chat_id'], r['title'], r['invite_link']) for r in rows]
+    CHANNELS_CACHE_TS = time.time()
+    return CHANNELS_CACHE
 
 async def check_subscription(user_id: int):
     channels = await get_channels()
     if not channels:
         return True, []
+    results = await asyncio.gather(
+        *[bot.get_chat_member(chat_id=chat_id, user_id=user_id) for chat_id, _, _ in channels],
+        return_exceptions=True
+    )
     not_subscribed = []
-    for chat_id, title, link in channels:
-        try:
-            member = await bot.get_chat_member(chat_id=chat_id, user_id=user_id)
-            if member.status in ['left', 'kicked']:
-                not_subscribed.append((title, link))
-        except Exception:
+    for (chat_id, title, link), member in zip(channels, results):
+        if isinstance(member, Exception) or member.status in ['left', 'kicked']:
             not_subscribed.append((title, link))
     return len(not_subscribed) == 0, not_subscribed
 
-async def get_user_balance(user_id: int) -> int:
-    async with db_pool.acquire() as conn:
-        balance = await conn.fetchval("SELECT balance FROM users WHERE user_id=$1", user_id)
-        return balance if balance is not None else 0
-
-async def update_user_balance(user_id: int, delta: int):
-    async with db_pool.acquire() as conn:
-        await conn.execute("UPDATE users SET balance = balance + $1 WHERE user_id=$2", delta, user_id)
+async def update_user_balance(user_id: int, delta: int) -> int:
+    async with acquire_conn() as conn:
+        balance = await conn.fetchval(SQL_UPDATE_BALANCE, delta, user_id)
+    return balance if balance is not None else 0
 
 async def get_random_user(exclude_id: int):
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
+        # Случайное смещение вместо ORDER BY RANDOM(): без сортировки всей таблицы
         row = await conn.fetchrow("""
-            SELECT user_id FROM users 
-            WHERE user_id != $1 AND user_id NOT IN (SELECT user_id FROM banned_users)
-            ORDER BY RANDOM() LIMIT 1
+            SELECT u.user_id FROM users u
+            WHERE u.user_id != $1
+              AND NOT EXISTS (SELECT 1 FROM banned_users b WHERE b.user_id = u.user_id)
+            OFFSET floor(random() * (
+                SELECT COUNT(*) FROM users u2
+                WHERE u2.user_id != $1
+                  AND NOT EXISTS (SELECT 1 FROM banned_users b2 WHERE b2.user_id = u2.user_id)
+            ))::bigint
+            LIMIT 1
         """, exclude_id)
         return row['user_id'] if row else None
 
+def format_date(value) -> str:
+    return value.astimezone().strftime("%Y-%m-%d %H:%M:%S") if value else "—"
+
 # ===== СОСТОЯНИЯ FSM =====
 class CreateGiveaway(StatesGroup):
     prize = State()
@@ -561,7 +861,8 @@ THEFT_VICTIM_DEFENSE_PHRASES = [
 @dp.message_handler(commands=['help'])
 async def cmd_help(message: types.Message):
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    admin_flag, banned = await get_user_flags(user_id)
+    if banned and not admin_flag:
         return
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
@@ -579,22 +880,24 @@ async def cmd_help(message: types.Message):
         "• 🔫 Ограбить – укради монеты у другого\n\n"
         "Администраторы имеют дополнительные функции в панели."
     )
-    await message.answer(text, reply_markup=user_main_keyboard(await is_admin(user_id)))
+    await message.answer(text, reply_markup=user_main_keyboard(admin_flag))
 
 # ===== СТАРТ =====
 @dp.message_handler(commands=['start'])
 async def cmd_start(message: types.Message):
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    admin_flag, banned = await get_user_flags(user_id)
+    if banned and not admin_flag:
         await message.answer("⛔ Вы заблокированы.")
         return
     username = message.from_user.username
     first_name = message.from_user.first_name
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await conn.execute(
-                "INSERT INTO users (user_id, username, first_name, joined_date, balance) VALUES ($1, $2, $3, $4, $5) ON CONFLICT (user_id) DO NOTHING",
-                user_id, username, first_name, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 0
+                "INSERT INTO users (user_id, username, first_name, joined_date, balance) VALUES ($1, $2, $3, now(), 0) "
+                "ON CONFLICT (user_id) DO UPDATE SET username=EXCLUDED.username, first_name=EXCLUDED.first_name",
+                user_id, username, first_name
             )
     except Exception as e:
         logging.error(f"DB error in start: {e}")
@@ -608,7 +911,6 @@ async def cmd_start(message: types.Message):
             reply_markup=subscription_inline(not_subscribed)
         )
         return
-    admin_flag = await is_admin(user_id)
     await message.answer(
         f"Привет, {first_name}!\n"
         f"Добро пожаловать в <b>Malboro GAME</b>! 🚬\n"
@@ -621,12 +923,12 @@ async def cmd_start(message: types.Message):
 # ===== ПРОВЕРКА ПОДПИСКИ =====
 @dp.callback_query_handler(lambda c: c.data == "check_sub")
 async def check_sub_callback(callback: types.CallbackQuery):
-    if await is_banned(callback.from_user.id) and not await is_admin(callback.from_user.id):
+    admin_flag, banned = await get_user_flags(callback.from_user.id)
+    if banned and not admin_flag:
         await callback.answer("⛔ Вы заблокированы.", show_alert=True)
         return
     ok, not_subscribed = await check_subscription(callback.from_user.id)
     if ok:
-        admin_flag = await is_admin(callback.from_user.id)
         await callback.message.edit_text("✅ Подписка подтверждена! Добро пожаловать.")
         await callback.message.answer("Главное меню:", reply_markup=user_main_keyboard(admin_flag))
     else:
@@ -641,14 +943,15 @@ async def no_link(callback: types.CallbackQuery):
 @dp.message_handler(lambda message: message.text == "👤 Профиль")
 async def profile_handler(message: types.Message):
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    admin_flag, banned = await get_user_flags(user_id)
+    if banned and not admin_flag:
         return
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             row = await conn.fetchrow(
                 "SELECT balance, joined_date, theft_attempts, theft_success, theft_failed, theft_protected FROM users WHERE user_id=$1",
                 user_id
@@ -658,7 +961,7 @@ async def profile_handler(message: types.Message):
             text = (
                 f"👤 Твой профиль:\n"
                 f"💰 Баланс: {balance} монет\n"
-                f"📅 Зарегистрирован: {joined}\n"
+                f"📅 Зарегистрирован: {format_date(joined)}\n"
                 f"🔫 Ограблений: {attempts} (успешно: {success}, провал: {failed})\n"
                 f"⚔️ Отбито атак: {protected}"
             )
@@ -667,25 +970,25 @@ async def profile_handler(message: types.Message):
     except Exception as e:
         logging.error(f"Profile error: {e}")
         text = "❌ Ошибка загрузки профиля."
-    await message.answer(text, reply_markup=user_main_keyboard(await is_admin(user_id)))
+    await message.answer(text, reply_markup=user_main_keyboard(admin_flag))
 
 # ===== БОНУС =====
 @dp.message_handler(lambda message: message.text == "🎁 Бонус")
 async def bonus_handler(message: types.Message):
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    admin_flag, banned = await get_user_flags(user_id)
+    if banned and not admin_flag:
         return
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
     try:
-        async with db_pool.acquire() as conn:
-            last_bonus_str = await conn.fetchval("SELECT last_bonus FROM users WHERE user_id=$1", user_id)
+        async with acquire_conn() as conn:
+            last_bonus = await conn.fetchval("SELECT last_bonus FROM users WHERE user_id=$1", user_id)
 
-        now = datetime.now()
-        if last_bonus_str:
-            last_bonus = datetime.strptime(last_bonus_str, "%Y-%m-%d %H:%M:%S")
+        now = datetime.now(timezone.utc)
+        if last_bonus:
             if now - last_bonus < timedelta(days=1):
                 remaining = timedelta(days=1) - (now - last_bonus)
                 hours = remaining.seconds // 3600
@@ -696,12 +999,12 @@ async def bonus_handler(message: types.Message):
         bonus = random.randint(5, 15)
         phrase = random.choice(BONUS_PHRASES).format(bonus=bonus)
 
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await conn.execute(
                 "UPDATE users SET balance = balance + $1, last_bonus = $2 WHERE user_id=$3",
-                bonus, now.strftime("%Y-%m-%d %H:%M:%S"), user_id
+                bonus, now, user_id
             )
-        await message.answer(phrase, reply_markup=user_main_keyboard(await is_admin(user_id)))
+        await message.answer(phrase, reply_markup=user_main_keyboard(admin_flag))
     except Exception as e:
         logging.error(f"Bonus error: {e}")
         await message.answer("❌ Ошибка при получении бонуса.")
@@ -710,14 +1013,15 @@ async def bonus_handler(message: types.Message):
 @dp.message_handler(lambda message: message.text == "🏆 Топ игроков")
 async def leaderboard_handler(message: types.Message):
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    admin_flag, banned = await get_user_flags(user_id)
+    if banned and not admin_flag:
         return
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             rows = await conn.fetch(
                 "SELECT first_name, balance FROM users ORDER BY balance DESC LIMIT 10"
             )
@@ -727,7 +1031,7 @@ async def leaderboard_handler(message: types.Message):
         text = "🏆 <b>Топ 10 игроков по балансу:</b>\n\n"
         for idx, row in enumerate(rows, 1):
             text += f"{idx}. {row['first_name']} – {row['balance']} монет\n"
-        await message.answer(text, reply_markup=user_main_keyboard(await is_admin(user_id)))
+        await message.answer(text, reply_markup=user_main_keyboard(admin_flag))
     except Exception as e:
         logging.error(f"Leaderboard error: {e}")
         await message.answer("❌ Ошибка загрузки топа.")
@@ -736,14 +1040,15 @@ async def leaderboard_handler(message: types.Message):
 @dp.message_handler(lambda message: message.text == "🛒 Магазин подарков")
 async def shop_handler(message: types.Message):
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    admin_flag, banned = await get_user_flags(user_id)
+    if banned and not admin_flag:
         return
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             rows = await conn.fetch("SELECT id, name, description, price, stock FROM shop_items")
         if not rows:
             await message.answer("🎁 В магазине пока нет подарков.")
@@ -767,7 +1072,8 @@ async def shop_handler(message: types.Message):
 @dp.callback_query_handler(lambda c: c.data.startswith("buy_"))
 async def buy_callback(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    admin_flag, banned = await get_user_flags(user_id)
+    if banned and not admin_flag:
         await callback.answer("⛔ Вы заблокированы.", show_alert=True)
         return
     ok, not_subscribed = await check_subscription(user_id)
@@ -776,7 +1082,7 @@ async def buy_callback(callback: types.CallbackQuery):
         return
     item_id = int(callback.data.split("_")[1])
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             row = await conn.fetchrow("SELECT name, price, stock FROM shop_items WHERE id=$1", item_id)
             if not row:
                 await callback.answer("Товар не найден", show_alert=True)
@@ -787,7 +1093,7 @@ async def buy_callback(callback: types.CallbackQuery):
                 await callback.answer("Товара нет в наличии!", show_alert=True)
                 return
 
-            balance = await conn.fetchval("SELECT balance FROM users WHERE user_id=$1", user_id)
+            balance = await conn.fetchval(SQL_GET_BALANCE, user_id)
             if balance is None:
                 await callback.answer("Пользователь не найден", show_alert=True)
                 return
@@ -800,8 +1106,8 @@ async def buy_callback(callback: types.CallbackQuery):
             async with conn.transaction():
                 await conn.execute("UPDATE users SET balance = balance - $1 WHERE user_id=$2", price, user_id)
                 await conn.execute(
-                    "INSERT INTO purchases (user_id, item_id, purchase_date) VALUES ($1, $2, $3)",
-                    user_id, item_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    "INSERT INTO purchases (user_id, item_id, purchase_date) VALUES ($1, $2, now())",
+                    user_id, item_id
                 )
                 if stock != -1:
                     await conn.execute("UPDATE shop_items SET stock = stock - 1 WHERE id=$1", item_id)
@@ -813,14 +1119,14 @@ async def buy_callback(callback: types.CallbackQuery):
             await callback.message.edit_text(f"✅ Покупка совершена!")
         except (MessageNotModified, MessageToEditNotFound):
             pass
-        await callback.message.answer("Главное меню:", reply_markup=user_main_keyboard(await is_admin(user_id)))
+        await callback.message.answer("Главное меню:", reply_markup=user_main_keyboard(admin_flag))
     except Exception as e:
         logging.error(f"Purchase error: {e}")
         await callback.answer("❌ Ошибка при покупке. Попробуй позже.", show_alert=True)
 
 async def notify_admins_about_purchase(user: types.User, item_name: str, price: int):
-    admins = SUPER_ADMINS.copy()
-    async with db_pool.acquire() as conn:
+    admins = list(SUPER_ADMINS)
+    async with acquire_conn() as conn:
         rows = await conn.fetch("SELECT user_id FROM admins")
         for row in rows:
             admins.append(row['user_id'])
@@ -834,29 +1140,30 @@ async def notify_admins_about_purchase(user: types.User, item_name: str, price:
 @dp.message_handler(lambda message: message.text == "💰 Мои покупки")
 async def my_purchases(message: types.Message):
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    admin_flag, banned = await get_user_flags(user_id)
+    if banned and not admin_flag:
         return
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             rows = await conn.fetch(
                 "SELECT p.id, s.name, p.purchase_date, p.status, p.admin_comment FROM purchases p JOIN shop_items s ON p.item_id = s.id WHERE p.user_id=$1 ORDER BY p.purchase_date DESC",
                 user_id
             )
         if not rows:
-            await message.answer("У тебя пока нет покупок.", reply_markup=user_main_keyboard(await is_admin(user_id)))
+            await message.answer("У тебя пока нет покупок.", reply_markup=user_main_keyboard(admin_flag))
             return
         text = "📦 Твои покупки:\n"
         for row in rows:
             pid, name, date, status, comment = row['id'], row['name'], row['purchase_date'], row['status'], row['admin_comment']
             status_emoji = "⏳" if status == 'pending' else "✅" if status == 'completed' else "❌"
-            text += f"{status_emoji} {name} от {date}\n"
+            text += f"{status_emoji} {name} от {format_date(date)}\n"
             if comment:
                 text += f"   Комментарий: {comment}\n"
-        await message.answer(text, reply_markup=user_main_keyboard(await is_admin(user_id)))
+        await message.answer(text, reply_markup=user_main_keyboard(admin_flag))
     except Exception as e:
         logging.error(f"My purchases error: {e}")
         await message.answer("❌ Ошибка загрузки покупок.")
@@ -865,7 +1172,8 @@ async def my_purchases(message: types.Message):
 @dp.message_handler(lambda message: message.text == "🎰 Казино")
 async def casino_handler(message: types.Message):
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    admin_flag, banned = await get_user_flags(user_id)
+    if banned and not admin_flag:
         return
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
@@ -895,27 +1203,29 @@ async def casino_bet_amount(message: types.Message, state: FSMContext):
         await state.finish()
         return
     try:
-        win_chance = int(await get_setting("casino_win_chance")) / 100
-        async with db_pool.acquire() as conn:
-            balance = await conn.fetchval("SELECT balance FROM users WHERE user_id=$1", user_id)
-            if amount > balance:
-                await message.answer("Недостаточно монет.")
-                await state.finish()
-                return
-            win = random.random() < win_chance
-            if win:
-                await conn.execute("UPDATE users SET balance = balance + $1 WHERE user_id=$2", amount, user_id)
-                profit = amount
-                win_amount = amount * 2
-                phrase = random.choice(CASINO_WIN_PHRASES).format(win=win_amount, profit=profit)
-            else:
-                await conn.execute("UPDATE users SET balance = balance - $1 WHERE user_id=$2", amount, user_id)
-                phrase = random.choice(CASINO_LOSE_PHRASES).format(loss=amount)
-            new_balance = await conn.fetchval("SELECT balance FROM users WHERE user_id=$1", user_id)
-        await message.answer(
-            f"{phrase}\n💰 Текущий баланс: {new_balance}",
-            reply_markup=user_main_keyboard(await is_admin(user_id))
-        )
+        win_chance = int(get_setting("casino_win_chance")) / 100
+        phrase = None
+        # В транзакции только работа с БД; ответ пользователю уходит после неё,
+        # чтобы блокировка строки не держалась на время запроса к Telegram
+        async with acquire_conn() as conn, conn.transaction():
+            balance = await conn.fetchval("SELECT balance FROM users WHERE user_id=$1 FOR UPDATE", user_id)
+            if balance is not None and amount <= balance:
+                win = random.random() < win_chance
+                if win:
+                    new_balance = await conn.fetchval(SQL_UPDATE_BALANCE, amount, user_id)
+                    profit = amount
+                    win_amount = amount * 2
+                    phrase = random.choice(CASINO_WIN_PHRASES).format(win=win_amount, profit=profit)
+                else:
+                    new_balance = await conn.fetchval(SQL_UPDATE_BALANCE, -amount, user_id)
+                    phrase = random.choice(CASINO_LOSE_PHRASES).format(loss=amount)
+        if phrase is None:
+            await message.answer("Недостаточно монет.")
+        else:
+            await message.answer(
+                f"{phrase}\n💰 Текущий баланс: {new_balance}",
+                reply_markup=user_main_keyboard(await is_admin(user_id))
+            )
     except Exception as e:
         logging.error(f"Casino error: {e}")
         await message.answer("❌ Ошибка в казино.")
@@ -925,7 +1235,8 @@ async def casino_bet_amount(message: types.Message, state: FSMContext):
 @dp.message_handler(lambda message: message.text == "🎟 Промокод")
 async def promo_handler(message: types.Message):
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    admin_flag, banned = await get_user_flags(user_id)
+    if banned and not admin_flag:
         return
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
@@ -948,7 +1259,7 @@ async def promo_activate(message: types.Message, state: FSMContext):
         await state.finish()
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             row = await conn.fetchrow("SELECT reward, max_uses, used_count FROM promocodes WHERE code=$1", code)
             if not row:
                 await message.answer("❌ Промокод не найден.")
@@ -974,28 +1285,29 @@ async def promo_activate(message: types.Message, state: FSMContext):
 @dp.message_handler(lambda message: message.text == "🎲 Розыгрыши")
 async def giveaways_handler(message: types.Message):
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    admin_flag, banned = await get_user_flags(user_id)
+    if banned and not admin_flag:
         return
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             rows = await conn.fetch("SELECT id, prize, end_date FROM giveaways WHERE status='active'")
         if not rows:
             await message.answer(
                 "Сейчас нет активных розыгрышей.",
-                reply_markup=user_main_keyboard(await is_admin(user_id))
+                reply_markup=user_main_keyboard(admin_flag)
             )
             return
         text = "🎁 Активные розыгрыши:\n\n"
         kb = []
         for row in rows:
             gid, prize, end = row['id'], row['prize'], row['end_date']
-            async with db_pool.acquire() as conn2:
+            async with acquire_conn() as conn2:
                 count = await conn2.fetchval("SELECT COUNT(*) FROM participants WHERE giveaway_id=$1", gid)
-            text += f"ID: {gid} | {prize} | до {end} | 👥 {count} участников\n"
+            text += f"ID: {gid} | {prize} | до {format_date(end)} | 👥 {count} участников\n"
             kb.append([InlineKeyboardButton(text=f"🔍 Подробнее о {prize}", callback_data=f"detail_{gid}")])
         kb.append([InlineKeyboardButton(text="« Назад", callback_data="back_main")])
         await message.answer(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
@@ -1005,12 +1317,13 @@ async def giveaways_handler(message: types.Message):
 
 @dp.callback_query_handler(lambda c: c.data.startswith("detail_"))
 async def giveaway_detail(callback: types.CallbackQuery):
-    if await is_banned(callback.from_user.id) and not await is_admin(callback.from_user.id):
+    admin_flag, banned = await get_user_flags(callback.from_user.id)
+    if banned and not admin_flag:
         await callback.answer("⛔ Вы заблокированы.", show_alert=True)
         return
     giveaway_id = int(callback.data.split("_")[1])
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             row = await conn.fetchrow(
                 "SELECT prize, description, end_date, media_file_id, media_type FROM giveaways WHERE id=$1 AND status='active'",
                 giveaway_id
@@ -1020,7 +1333,7 @@ async def giveaway_detail(callback: types.CallbackQuery):
             await callback.answer("Розыгрыш не найден или завершён.", show_alert=True)
             return
         prize, desc, end_date, media_file_id, media_type = row['prize'], row['description'], row['end_date'], row['media_file_id'], row['media_type']
-        caption = f"🎁 Розыгрыш: {prize}\n📝 {desc}\n📅 Окончание: {end_date}\n👥 Участников: {participants_count}\n\nЖелаешь участвовать?"
+        caption = f"🎁 Розыгрыш: {prize}\n📝 {desc}\n📅 Окончание: {format_date(end_date)}\n👥 Участников: {participants_count}\n\nЖелаешь участвовать?"
         confirm_kb = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="✅ Да, участвую", callback_data=f"confirm_part_{giveaway_id}")],
             [InlineKeyboardButton(text="❌ Нет", callback_data="cancel_detail")]
@@ -1041,7 +1354,8 @@ async def giveaway_detail(callback: types.CallbackQuery):
 
 @dp.callback_query_handler(lambda c: c.data.startswith("confirm_part_"))
 async def confirm_participation(callback: types.CallbackQuery):
-    if await is_banned(callback.from_user.id) and not await is_admin(callback.from_user.id):
+    admin_flag, banned = await get_user_flags(callback.from_user.id)
+    if banned and not admin_flag:
         await callback.answer("⛔ Вы заблокированы.", show_alert=True)
         return
     giveaway_id = int(callback.data.split("_")[2])
@@ -1051,7 +1365,7 @@ async def confirm_participation(callback: types.CallbackQuery):
         await callback.message.edit_text("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             status = await conn.fetchval("SELECT status FROM giveaways WHERE id=$1", giveaway_id)
             if not status or status != 'active':
                 await callback.answer("Розыгрыш не активен", show_alert=True)
@@ -1065,16 +1379,17 @@ async def confirm_participation(callback: types.CallbackQuery):
 
 @dp.callback_query_handler(lambda c: c.data == "cancel_detail")
 async def cancel_detail(callback: types.CallbackQuery):
-    if await is_banned(callback.from_user.id) and not await is_admin(callback.from_user.id):
+    admin_flag, banned = await get_user_flags(callback.from_user.id)
+    if banned and not admin_flag:
         return
     await callback.message.delete()
     await giveaways_handler(callback.message)
 
 @dp.callback_query_handler(lambda c: c.data == "back_main")
 async def back_main_callback(callback: types.CallbackQuery):
-    if await is_banned(callback.from_user.id) and not await is_admin(callback.from_user.id):
+    admin_flag, banned = await get_user_flags(callback.from_user.id)
+    if banned and not admin_flag:
         return
-    admin_flag = await is_admin(callback.from_user.id)
     await callback.message.delete()
     await callback.message.answer("Главное меню:", reply_markup=user_main_keyboard(admin_flag))
 
@@ -1082,7 +1397,8 @@ async def back_main_callback(callback: types.CallbackQuery):
 @dp.message_handler(lambda message: message.text == "🔫 Ограбить")
 async def theft_menu(message: types.Message):
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    admin_flag, banned = await get_user_flags(user_id)
+    if banned and not admin_flag:
         return
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
@@ -1094,44 +1410,32 @@ async def theft_menu(message: types.Message):
 @dp.message_handler(lambda message: message.text == "🎲 Случайная цель")
 async def theft_random(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    cooldown_minutes = int(await get_setting("theft_cooldown_minutes"))
-    async with db_pool.acquire() as conn:
-        last_time_str = await conn.fetchval("SELECT last_theft_time FROM users WHERE user_id=$1", user_id)
-        if last_time_str:
-            last_time = datetime.strptime(last_time_str, "%Y-%m-%d %H:%M:%S")
-            diff = datetime.now() - last_time
-            if diff < timedelta(minutes=cooldown_minutes):
-                remaining = cooldown_minutes - int(diff.total_seconds() // 60)
-                phrase = random.choice(THEFT_COOLDOWN_PHRASES).format(minutes=remaining)
-                await message.answer(phrase, reply_markup=user_main_keyboard(await is_admin(user_id)))
-                return
+    cooldown_minutes = int(get_setting("theft_cooldown_minutes"))
+    async with acquire_conn() as conn:
+        elapsed = await conn.fetchval(SQL_THEFT_ELAPSED, user_id)
+        if elapsed is not None and elapsed < cooldown_minutes * 60:
+            remaining = cooldown_minutes - int(elapsed // 60)
+            phrase = random.choice(THEFT_COOLDOWN_PHRASES).format(minutes=remaining)
+            await message.answer(phrase, reply_markup=user_main_keyboard(await is_admin(user_id)))
+            return
     target_id = await get_random_user(user_id)
     if not target_id:
         await message.answer("😕 В игре пока нет других игроков.", reply_markup=user_main_keyboard(await is_admin(user_id)))
         return
-    cost = int(await get_setting("random_attack_cost"))
-    if cost > 0:
-        balance = await get_user_balance(user_id)
-        if balance < cost:
-            await message.answer(random.choice(THEFT_NO_MONEY_PHRASES), reply_markup=user_main_keyboard(await is_admin(user_id)))
-            return
-        await update_user_balance(user_id, -cost)
-    await perform_theft(message, user_id, target_id)
+    cost = int(get_setting("random_attack_cost"))
+    await perform_theft(message, user_id, target_id, cost)
 
 @dp.message_handler(lambda message: message.text == "👤 Выбрать пользователя")
 async def theft_choose_user(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    cooldown_minutes = int(await get_setting("theft_cooldown_minutes"))
-    async with db_pool.acquire() as conn:
-        last_time_str = await conn.fetchval("SELECT last_theft_time FROM users WHERE user_id=$1", user_id)
-        if last_time_str:
-            last_time = datetime.strptime(last_time_str, "%Y-%m-%d %H:%M:%S")
-            diff = datetime.now() - last_time
-            if diff < timedelta(minutes=cooldown_minutes):
-                remaining = cooldown_minutes - int(diff.total_seconds() // 60)
-                phrase = random.choice(THEFT_COOLDOWN_PHRASES).format(minutes=remaining)
-                await message.answer(phrase, reply_markup=user_main_keyboard(await is_admin(user_id)))
-                return
+    cooldown_minutes = int(get_setting("theft_cooldown_minutes"))
+    async with acquire_conn() as conn:
+        elapsed = await conn.fetchval(SQL_THEFT_ELAPSED, user_id)
+        if elapsed is not None and elapsed < cooldown_minutes * 60:
+            remaining = cooldown_minutes - int(elapsed // 60)
+            phrase = random.choice(THEFT_COOLDOWN_PHRASES).format(minutes=remaining)
+            await message.answer(phrase, reply_markup=user_main_keyboard(await is_admin(user_id)))
+            return
     await message.answer("Введи @username или ID того, кого хочешь ограбить:", reply_markup=back_keyboard())
     await TheftTarget.target.set()
 
@@ -1147,13 +1451,13 @@ async def theft_target_entered(message: types.Message, state: FSMContext):
     target_id = None
     if target_input.startswith('@'):
         username = target_input[1:].lower()
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             target_id = await conn.fetchval("SELECT user_id FROM users WHERE LOWER(username)=$1", username)
     else:
         try:
             target_id = int(target_input)
         except ValueError:
-            async with db_pool.acquire() as conn:
+            async with acquire_conn() as conn:
                 target_id = await conn.fetchval("SELECT user_id FROM users WHERE LOWER(username)=$1", target_input.lower())
 
     if not target_id:
@@ -1170,69 +1474,89 @@ async def theft_target_entered(message: types.Message, state: FSMContext):
         await state.finish()
         return
 
-    cost = int(await get_setting("targeted_attack_cost"))
-    if cost > 0:
-        balance = await get_user_balance(robber_id)
-        if balance < cost:
-            await message.answer(random.choice(THEFT_NO_MONEY_PHRASES), reply_markup=user_main_keyboard(await is_admin(robber_id)))
-            await state.finish()
-            return
-        await update_user_balance(robber_id, -cost)
-
-    await perform_theft(message, robber_id, target_id)
+    cost = int(get_setting("targeted_attack_cost"))
+    await perform_theft(message, robber_id, target_id, cost)
     await state.finish()
 
-async def perform_theft(message: types.Message, robber_id: int, victim_id: int):
+async def perform_theft(message: types.Message, robber_id: int, victim_id: int, cost: int):
     try:
-        async with db_pool.acquire() as conn:
-            victim_balance = await conn.fetchval("SELECT balance FROM users WHERE user_id=$1", victim_id)
-            if victim_balance is None:
-                await message.answer("❌ Цель не найдена в базе.")
-                return
-
-            success_chance = int(await get_setting("theft_success_chance"))
-            defense_chance = int(await get_setting("theft_defense_chance"))
-            defense_penalty = int(await get_setting("theft_defense_penalty"))
-            min_amount = int(await get_setting("min_theft_amount"))
-            max_amount = int(await get_setting("max_theft_amount"))
-
-            victim_info = await conn.fetchrow("SELECT username, first_name FROM users WHERE user_id=$1", victim_id)
-            victim_name = victim_info['first_name'] if victim_info else str(victim_id)
-
-            defense_triggered = random.randint(1, 100) <= defense_chance
-            if defense_triggered:
-                penalty = defense_penalty
-                robber_balance = await get_user_balance(robber_id)
-                if penalty > robber_balance:
-                    penalty = robber_balance
-                if penalty > 0:
-                    await conn.execute("UPDATE users SET balance = balance - $1 WHERE user_id=$2", penalty, robber_id)
-                    await conn.execute("UPDATE users SET balance = balance + $1 WHERE user_id=$2", penalty, victim_id)
-                await conn.execute("UPDATE users SET theft_attempts = theft_attempts + 1, theft_failed = theft_failed + 1 WHERE user_id=$1", robber_id)
-                await conn.execute("UPDATE users SET theft_protected = theft_protected + 1 WHERE user_id=$1", victim_id)
-                await conn.execute("UPDATE users SET last_theft_time = $1 WHERE user_id=$2", datetime.now().strftime("%Y-%m-%d %H:%M:%S"), robber_id)
-
-                robber_phrase = random.choice(THEFT_DEFENSE_PHRASES).format(target=victim_name, penalty=penalty)
-                victim_phrase = random.choice(THEFT_VICTIM_DEFENSE_PHRASES).format(attacker=message.from_user.first_name, penalty=penalty)
-                await message.answer(robber_phrase, reply_markup=user_main_keyboard(await is_admin(robber_id)))
-                await safe_send_message(victim_id, victim_phrase)
-                return
-
-            success = random.randint(1, 100) <= success_chance
-            if success and victim_balance > 0:
-                steal_amount = random.randint(min_amount, min(max_amount, victim_balance))
-                await conn.execute("UPDATE users SET balance = balance - $1 WHERE user_id=$2", steal_amount, victim_id)
-                await conn.execute("UPDATE users SET balance = balance + $1 WHERE user_id=$2", steal_amount, robber_id)
-                await conn.execute("UPDATE users SET theft_attempts = theft_attempts + 1, theft_success = theft_success + 1 WHERE user_id=$1", robber_id)
-                phrase = random.choice(THEFT_SUCCESS_PHRASES).format(amount=steal_amount, target=victim_name)
-                await message.answer(phrase, reply_markup=user_main_keyboard(await is_admin(robber_id)))
-                await safe_send_message(victim_id, f"🔫 Вас ограбили! {message.from_user.first_name} украл {steal_amount} монет.")
-            else:
-                await conn.execute("UPDATE users SET theft_attempts = theft_attempts + 1, theft_failed = theft_failed + 1 WHERE user_id=$1", robber_id)
-                phrase = random.choice(THEFT_FAIL_PHRASES).format(target=victim_name)
-                await message.answer(phrase, reply_markup=user_main_keyboard(await is_admin(robber_id)))
-
-            await conn.execute("UPDATE users SET last_theft_time = $1 WHERE user_id=$2", datetime.now().strftime("%Y-%m-%d %H:%M:%S"), robber_id)
+        cooldown_minutes = int(get_setting("theft_cooldown_minutes"))
+        success_chance = int(get_setting("theft_success_chance"))
+        defense_chance = int(get_setting("theft_defense_chance"))
+        defense_penalty = int(get_setting("theft_defense_penalty"))
+        min_amount = int(get_setting("min_theft_amount"))
+        max_amount = int(get_setting("max_theft_amount"))
+
+        # Все изменения балансов и счётчиков – в одной транзакции,
+        # строки грабителя и жертвы блокируются в порядке user_id.
+        # Кулдаун и стоимость атаки проверяются уже под блокировкой, иначе
+        # несколько одновременных обновлений от одного игрока проходят проверку разом.
+        # Ответы отправляются после транзакции
+        refusal = None
+        async with acquire_conn() as conn, conn.transaction():
+            rows = await conn.fetch(
+                "SELECT user_id, balance, first_name, EXTRACT(EPOCH FROM now() - last_theft_time)::float8 AS elapsed "
+                "FROM users WHERE user_id = ANY($1::bigint[]) ORDER BY user_id FOR UPDATE",
+                [robber_id, victim_id]
+            )
+            users = {r['user_id']: r for r in rows}
+            elapsed = users[robber_id]['elapsed'] if robber_id in users else None
+            robber_balance = users[robber_id]['balance'] if robber_id in users else 0
+            if victim_id not in users:
+                refusal = "❌ Цель не найдена в базе."
+            elif elapsed is not None and elapsed < cooldown_minutes * 60:
+                remaining = cooldown_minutes - int(elapsed // 60)
+                refusal = random.choice(THEFT_COOLDOWN_PHRASES).format(minutes=remaining)
+            elif cost > 0 and robber_balance < cost:
+                refusal = random.choice(THEFT_NO_MONEY_PHRASES)
+            if refusal is None:
+                if cost > 0:
+                    await conn.execute(SQL_SPEND_BALANCE, cost, robber_id)
+                    robber_balance -= cost
+                victim_balance = users[victim_id]['balance']
+                victim_name = users[victim_id]['first_name'] or str(victim_id)
+                defense_triggered = random.randint(1, 100) <= defense_chance
+                success = False
+                if defense_triggered:
+                    penalty = max(0, min(defense_penalty, robber_balance))
+                    await conn.execute(
+                        "UPDATE users SET balance = balance - $1, theft_attempts = theft_attempts + 1, theft_failed = theft_failed + 1, last_theft_time = now() WHERE user_id=$2",
+                        penalty, robber_id
+                    )
+                    await conn.execute(
+                        "UPDATE users SET balance = balance + $1, theft_protected = theft_protected + 1 WHERE user_id=$2",
+                        penalty, victim_id
+                    )
+                else:
+                    success = random.randint(1, 100) <= success_chance and victim_balance > 0
+                    if success:
+                        steal_amount = random.randint(min_amount, min(max_amount, victim_balance))
+                        await conn.execute("UPDATE users SET balance = balance - $1 WHERE user_id=$2", steal_amount, victim_id)
+                        await conn.execute(
+                            "UPDATE users SET balance = balance + $1, theft_attempts = theft_attempts + 1, theft_success = theft_success + 1, last_theft_time = now() WHERE user_id=$2",
+                            steal_amount, robber_id
+                        )
+                    else:
+                        await conn.execute(
+                            "UPDATE users SET theft_attempts = theft_attempts + 1, theft_failed = theft_failed + 1, last_theft_time = now() WHERE user_id=$1",
+                            robber_id
+                        )
+
+        keyboard = user_main_keyboard(await is_admin(robber_id))
+        if refusal is not None:
+            await message.answer(refusal, reply_markup=keyboard)
+        elif defense_triggered:
+            robber_phrase = random.choice(THEFT_DEFENSE_PHRASES).format(target=victim_name, penalty=penalty)
+            victim_phrase = random.choice(THEFT_VICTIM_DEFENSE_PHRASES).format(attacker=message.from_user.first_name, penalty=penalty)
+            await message.answer(robber_phrase, reply_markup=keyboard)
+            await safe_send_message(victim_id, victim_phrase)
+        elif success:
+            phrase = random.choice(THEFT_SUCCESS_PHRASES).format(amount=steal_amount, target=victim_name)
+            await message.answer(phrase, reply_markup=keyboard)
+            await safe_send_message(victim_id, f"🔫 Вас ограбили! {message.from_user.first_name} украл {steal_amount} монет.")
+        else:
+            phrase = random.choice(THEFT_FAIL_PHRASES).format(target=victim_name)
+            await message.answer(phrase, reply_markup=keyboard)
 
     except Exception as e:
         logging.error(f"Theft error: {e}")
@@ -1244,7 +1568,7 @@ async def admin_panel(message: types.Message):
     if not await is_admin(message.from_user.id):
         await message.answer("У тебя нет прав администратора.")
         return
-    super_admin = await is_super_admin(message.from_user.id)
+    super_admin = is_super_admin(message.from_user.id)
     await message.answer("Панель администратора:", reply_markup=admin_main_keyboard(super_admin))
 
 # ===== УПРАВЛЕНИЕ РОЗЫГРЫШАМИ =====
@@ -1288,11 +1612,11 @@ async def create_giveaway_end_date(message: types.Message, state: FSMContext):
         await admin_giveaway_menu(message)
         return
     try:
-        end_date = datetime.strptime(message.text, "%d.%m.%Y %H:%M")
-        if end_date <= datetime.now():
+        end_date = datetime.strptime(message.text, "%d.%m.%Y %H:%M").astimezone()
+        if end_date <= datetime.now(timezone.utc):
             await message.answer("Дата окончания должна быть в будущем.")
             return
-        await state.update_data(end_date=end_date.strftime("%Y-%m-%d %H:%M:%S"))
+        await state.update_data(end_date=end_date.isoformat())
     except ValueError:
         await message.answer("Неверный формат. Используй ДД.ММ.ГГГГ ЧЧ:ММ")
         return
@@ -1324,11 +1648,12 @@ async def create_giveaway_media(message: types.Message, state: FSMContext):
         return
 
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await conn.execute(
                 "INSERT INTO giveaways (prize, description, end_date, media_file_id, media_type) VALUES ($1, $2, $3, $4, $5)",
-                data['prize'], data['description'], data['end_date'], media_file_id, media_type
+                data['prize'], data['description'], datetime.fromisoformat(data['end_date']), media_file_id, media_type
             )
+            await notify_giveaways_changed(conn)
         await message.answer("✅ Розыгрыш создан!", reply_markup=giveaway_admin_keyboard())
     except Exception as e:
         logging.error(f"Create giveaway error: {e}")
@@ -1340,7 +1665,7 @@ async def list_active_giveaways(message: types.Message):
     if not await is_admin(message.from_user.id):
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             rows = await conn.fetch("SELECT id, prize, end_date, description FROM giveaways WHERE status='active'")
         if not rows:
             await message.answer("Нет активных розыгрышей.")
@@ -1348,9 +1673,9 @@ async def list_active_giveaways(message: types.Message):
         text = "Активные розыгрыши:\n"
         for row in rows:
             gid, prize, end, desc = row['id'], row['prize'], row['end_date'], row['description']
-            async with db_pool.acquire() as conn2:
+            async with acquire_conn() as conn2:
                 count = await conn2.fetchval("SELECT COUNT(*) FROM participants WHERE giveaway_id=$1", gid)
-            text += f"ID: {gid} | {prize} | до {end} | 👥 {count} участников\n{desc}\n\n"
+            text += f"ID: {gid} | {prize} | до {format_date(end)} | 👥 {count} участников\n{desc}\n\n"
         await message.answer(text, reply_markup=giveaway_admin_keyboard())
     except Exception as e:
         logging.error(f"List giveaways error: {e}")
@@ -1394,7 +1719,7 @@ async def finish_giveaway_winners(message: types.Message, state: FSMContext):
     data = await state.get_data()
     gid = data['giveaway_id']
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             status = await conn.fetchval("SELECT status FROM giveaways WHERE id=$1", gid)
             if not status or status != 'active':
                 await message.answer("Розыгрыш не активен или не существует.")
@@ -1461,11 +1786,12 @@ async def add_channel_link(message: types.Message, state: FSMContext):
     link = None if message.text.lower() == 'нет' else message.text.strip()
     data = await state.get_data()
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await conn.execute(
                 "INSERT INTO channels (chat_id, title, invite_link) VALUES ($1, $2, $3)",
                 data['chat_id'], data['title'], link
             )
+        invalidate_channels_cache()
         await message.answer("✅ Канал добавлен!", reply_markup=channel_admin_keyboard())
     except asyncpg.UniqueViolationError:
         await message.answer("❌ Канал с таким chat_id уже существует.")
@@ -1489,8 +1815,9 @@ async def remove_channel(message: types.Message, state: FSMContext):
         return
     chat_id = message.text.strip()
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await conn.execute("DELETE FROM channels WHERE chat_id=$1", chat_id)
+        invalidate_channels_cache()
         await message.answer("✅ Канал удалён, если существовал.", reply_markup=channel_admin_keyboard())
     except Exception as e:
         logging.error(f"Remove channel error: {e}")
@@ -1574,7 +1901,7 @@ async def add_shop_item_stock(message: types.Message, state: FSMContext):
         return
     data = await state.get_data()
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await conn.execute(
                 "INSERT INTO shop_items (name, description, price, stock) VALUES ($1, $2, $3, $4)",
                 data['name'], data['description'], data['price'], stock
@@ -1590,7 +1917,7 @@ async def remove_shop_item_start(message: types.Message):
     if not await is_admin(message.from_user.id):
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             items = await conn.fetch("SELECT id, name FROM shop_items ORDER BY id")
         if not items:
             await message.answer("В магазине нет товаров.")
@@ -1615,7 +1942,7 @@ async def remove_shop_item(message: types.Message, state: FSMContext):
         await message.answer("Введи число.")
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await conn.execute("DELETE FROM shop_items WHERE id=$1", item_id)
         await message.answer("✅ Товар удалён, если существовал.", reply_markup=shop_admin_keyboard())
     except Exception as e:
@@ -1628,7 +1955,7 @@ async def list_shop_items(message: types.Message):
     if not await is_admin(message.from_user.id):
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             items = await conn.fetch("SELECT id, name, description, price, stock FROM shop_items ORDER BY id")
         if not items:
             await message.answer("В магазине нет товаров.")
@@ -1692,7 +2019,7 @@ async def edit_shop_item_final(message: types.Message, state: FSMContext):
     item_id = data['item_id']
     field = data['field']
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await conn.execute(f"UPDATE shop_items SET {field}=$1 WHERE id=$2", value, item_id)
         await message.answer("✅ Товар обновлён.", reply_markup=shop_admin_keyboard())
     except Exception as e:
@@ -1757,7 +2084,7 @@ async def create_promo_max_uses(message: types.Message, state: FSMContext):
         return
     data = await state.get_data()
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await conn.execute(
                 "INSERT INTO promocodes (code, reward, max_uses) VALUES ($1, $2, $3)",
                 data['code'], data['reward'], max_uses
@@ -1775,7 +2102,7 @@ async def list_promos(message: types.Message):
     if not await is_admin(message.from_user.id):
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             rows = await conn.fetch("SELECT code, reward, max_uses, used_count FROM promocodes")
         if not rows:
             await message.answer("Нет промокодов.")
@@ -1793,11 +2120,7 @@ async def list_promos(message: types.Message):
 async def settings_menu(message: types.Message):
     if not await is_admin(message.from_user.id):
         return
-    settings = {}
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch("SELECT key, value FROM settings")
-        for key, value in rows:
-            settings[key] = value
+    settings = SETTINGS_CACHE
     text = "⚙️ <b>Текущие настройки игры:</b>\n\n"
     text += f"💰 Стоимость случайной кражи: {settings.get('random_attack_cost', '0')} монет\n"
     text += f"👤 Стоимость кражи по username: {settings.get('targeted_attack_cost', '50')} монет\n"
@@ -1854,7 +2177,7 @@ async def set_setting_value(message: types.Message, state: FSMContext):
 async def back_to_admin(callback: types.CallbackQuery):
     if not await is_admin(callback.from_user.id):
         return
-    super_admin = await is_super_admin(callback.from_user.id)
+    super_admin = is_super_admin(callback.from_user.id)
     await callback.message.edit_text("Панель администратора:", reply_markup=admin_main_keyboard(super_admin))
     await callback.answer()
 
@@ -1864,7 +2187,7 @@ async def stats_handler(message: types.Message):
     if not await is_admin(message.from_user.id):
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             users = await conn.fetchval("SELECT COUNT(*) FROM users")
             total_balance = await conn.fetchval("SELECT SUM(balance) FROM users") or 0
             active_giveaways = await conn.fetchval("SELECT COUNT(*) FROM giveaways WHERE status='active'") or 0
@@ -1887,7 +2210,7 @@ async def stats_handler(message: types.Message):
             f"🎫 Промокодов создано: {promos}\n"
             f"⛔ Заблокировано: {banned}"
         )
-        await message.answer(text, reply_markup=admin_main_keyboard(await is_super_admin(message.from_user.id)))
+        await message.answer(text, reply_markup=admin_main_keyboard(is_super_admin(message.from_user.id)))
     except Exception as e:
         logging.error(f"Stats error: {e}")
         await message.answer("❌ Ошибка получения статистики.")
@@ -1904,7 +2227,7 @@ async def find_user_start(message: types.Message):
 async def find_user_result(message: types.Message, state: FSMContext):
     if message.text == "◀️ Назад":
         await state.finish()
-        super_admin = await is_super_admin(message.from_user.id)
+        super_admin = is_super_admin(message.from_user.id)
         await message.answer("Панель администратора:", reply_markup=admin_main_keyboard(super_admin))
         return
     query = message.text.strip()
@@ -1912,7 +2235,7 @@ async def find_user_result(message: types.Message, state: FSMContext):
         row = None
         try:
             uid = int(query)
-            async with db_pool.acquire() as conn:
+            async with acquire_conn() as conn:
                 row = await conn.fetchrow(
                     "SELECT user_id, first_name, balance, joined_date, theft_attempts, theft_success, theft_failed, theft_protected FROM users WHERE user_id=$1",
                     uid
@@ -1921,7 +2244,7 @@ async def find_user_result(message: types.Message, state: FSMContext):
             username = query.lower()
             if username.startswith('@'):
                 username = username[1:]
-            async with db_pool.acquire() as conn:
+            async with acquire_conn() as conn:
                 row = await conn.fetchrow(
                     "SELECT user_id, first_name, balance, joined_date, theft_attempts, theft_success, theft_failed, theft_protected FROM users WHERE LOWER(username)=$1",
                     username
@@ -1935,7 +2258,7 @@ async def find_user_result(message: types.Message, state: FSMContext):
         text = (
             f"👤 Пользователь: {name} (ID: {uid})\n"
             f"💰 Баланс: {bal}\n"
-            f"📅 Регистрация: {joined}\n"
+            f"📅 Регистрация: {format_date(joined)}\n"
             f"🔫 Ограблений: {attempts} (успешно: {success}, провал: {failed})\n"
             f"⚔️ Отбито атак: {protected}\n"
             f"Статус: {ban_status}"
@@ -1952,7 +2275,7 @@ async def admin_purchases(message: types.Message):
     if not await is_admin(message.from_user.id):
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             rows = await conn.fetch(
                 "SELECT p.id, u.user_id, u.username, s.name, p.purchase_date, p.status FROM purchases p JOIN users u ON p.user_id = u.user_id JOIN shop_items s ON p.item_id = s.id WHERE p.status='pending' ORDER BY p.purchase_date"
             )
@@ -1961,7 +2284,7 @@ async def admin_purchases(message: types.Message):
             return
         for row in rows:
             pid, uid, username, item_name, date, status = row['id'], row['user_id'], row['username'], row['name'], row['purchase_date'], row['status']
-            text = f"🆔 {pid}\nПользователь: {uid} (@{username})\nТовар: {item_name}\nДата: {date}"
+            text = f"🆔 {pid}\nПользователь: {uid} (@{username})\nТовар: {item_name}\nДата: {format_date(date)}"
             await message.answer(text, reply_markup=purchase_action_keyboard(pid))
     except Exception as e:
         logging.error(f"Admin purchases error: {e}")
@@ -1974,7 +2297,7 @@ async def purchase_done(callback: types.CallbackQuery):
         return
     purchase_id = int(callback.data.split("_")[2])
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await conn.execute("UPDATE purchases SET status='completed' WHERE id=$1", purchase_id)
             user_id = await conn.fetchval("SELECT user_id FROM purchases WHERE id=$1", purchase_id)
             if user_id:
@@ -1992,7 +2315,7 @@ async def purchase_reject(callback: types.CallbackQuery):
         return
     purchase_id = int(callback.data.split("_")[2])
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await conn.execute("UPDATE purchases SET status='rejected' WHERE id=$1", purchase_id)
             user_id = await conn.fetchval("SELECT user_id FROM purchases WHERE id=$1", purchase_id)
             if user_id:
@@ -2006,7 +2329,7 @@ async def purchase_reject(callback: types.CallbackQuery):
 # ===== ДОБАВЛЕНИЕ МЛАДШЕГО АДМИНА =====
 @dp.message_handler(lambda message: message.text == "➕ Добавить админа")
 async def add_admin_start(message: types.Message):
-    if not await is_super_admin(message.from_user.id):
+    if not is_super_admin(message.from_user.id):
         await message.answer("Только суперадмин может добавлять админов.")
         return
     await message.answer("Введи ID пользователя, которого хочешь сделать младшим админом:", reply_markup=back_keyboard())
@@ -2016,7 +2339,7 @@ async def add_admin_start(message: types.Message):
 async def add_admin_finish(message: types.Message, state: FSMContext):
     if message.text == "◀️ Назад":
         await state.finish()
-        super_admin = await is_super_admin(message.from_user.id)
+        super_admin = is_super_admin(message.from_user.id)
         await message.answer("Панель администратора:", reply_markup=admin_main_keyboard(super_admin))
         return
     try:
@@ -2025,14 +2348,14 @@ async def add_admin_finish(message: types.Message, state: FSMContext):
         await message.answer("❌ Введи числовой ID.")
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             exists = await conn.fetchval("SELECT user_id FROM users WHERE user_id=$1", uid)
             if not exists:
                 await message.answer("❌ Пользователь с таким ID не найден в боте.")
                 return
             await conn.execute(
-                "INSERT INTO admins (user_id, added_by, added_date) VALUES ($1, $2, $3)",
-                uid, message.from_user.id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                "INSERT INTO admins (user_id, added_by, added_date) VALUES ($1, $2, now())",
+                uid, message.from_user.id
             )
         await message.answer(f"✅ Пользователь {uid} теперь младший админ.")
     except asyncpg.UniqueViolationError:
@@ -2045,7 +2368,7 @@ async def add_admin_finish(message: types.Message, state: FSMContext):
 # ===== УДАЛЕНИЕ МЛАДШЕГО АДМИНА =====
 @dp.message_handler(lambda message: message.text == "➖ Удалить админа")
 async def remove_admin_start(message: types.Message):
-    if not await is_super_admin(message.from_user.id):
+    if not is_super_admin(message.from_user.id):
         await message.answer("Только суперадмин может удалять админов.")
         return
     await message.answer("Введи ID пользователя, которого хочешь лишить прав админа:", reply_markup=back_keyboard())
@@ -2055,7 +2378,7 @@ async def remove_admin_start(message: types.Message):
 async def remove_admin_finish(message: types.Message, state: FSMContext):
     if message.text == "◀️ Назад":
         await state.finish()
-        super_admin = await is_super_admin(message.from_user.id)
+        super_admin = is_super_admin(message.from_user.id)
         await message.answer("Панель администратора:", reply_markup=admin_main_keyboard(super_admin))
         return
     try:
@@ -2064,7 +2387,7 @@ async def remove_admin_finish(message: types.Message, state: FSMContext):
         await message.answer("❌ Введи числовой ID.")
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await conn.execute("DELETE FROM admins WHERE user_id=$1", uid)
         await message.answer(f"✅ Пользователь {uid} больше не админ, если был им.")
     except Exception as e:
@@ -2084,7 +2407,7 @@ async def block_user_start(message: types.Message):
 async def block_user_id(message: types.Message, state: FSMContext):
     if message.text == "◀️ Назад":
         await state.finish()
-        super_admin = await is_super_admin(message.from_user.id)
+        super_admin = is_super_admin(message.from_user.id)
         await message.answer("Панель администратора:", reply_markup=admin_main_keyboard(super_admin))
         return
     try:
@@ -2104,17 +2427,17 @@ async def block_user_id(message: types.Message, state: FSMContext):
 async def block_user_reason(message: types.Message, state: FSMContext):
     if message.text == "◀️ Назад":
         await state.finish()
-        super_admin = await is_super_admin(message.from_user.id)
+        super_admin = is_super_admin(message.from_user.id)
         await message.answer("Панель администратора:", reply_markup=admin_main_keyboard(super_admin))
         return
     reason = None if message.text.lower() == 'нет' else message.text
     data = await state.get_data()
     uid = data['user_id']
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await conn.execute(
-                "INSERT INTO banned_users (user_id, banned_by, banned_date, reason) VALUES ($1, $2, $3, $4) ON CONFLICT (user_id) DO NOTHING",
-                uid, message.from_user.id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), reason
+                "INSERT INTO banned_users (user_id, banned_by, banned_date, reason) VALUES ($1, $2, now(), $3) ON CONFLICT (user_id) DO NOTHING",
+                uid, message.from_user.id, reason
             )
         await message.answer(f"✅ Пользователь {uid} заблокирован.")
         safe_send_message_task(uid, f"⛔ Вы заблокированы в боте. Причина: {reason if reason else 'не указана'}")
@@ -2135,7 +2458,7 @@ async def unblock_user_start(message: types.Message):
 async def unblock_user_finish(message: types.Message, state: FSMContext):
     if message.text == "◀️ Назад":
         await state.finish()
-        super_admin = await is_super_admin(message.from_user.id)
+        super_admin = is_super_admin(message.from_user.id)
         await message.answer("Панель администратора:", reply_markup=admin_main_keyboard(super_admin))
         return
     try:
@@ -2144,7 +2467,7 @@ async def unblock_user_finish(message: types.Message, state: FSMContext):
         await message.answer("❌ Введи числовой ID.")
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await conn.execute("DELETE FROM banned_users WHERE user_id=$1", uid)
         await message.answer(f"✅ Пользователь {uid} разблокирован.")
         safe_send_message_task(uid, "🔓 Вы разблокированы в боте.")
@@ -2165,7 +2488,7 @@ async def remove_balance_start(message: types.Message):
 async def remove_balance_user(message: types.Message, state: FSMContext):
     if message.text == "◀️ Назад":
         await state.finish()
-        super_admin = await is_super_admin(message.from_user.id)
+        super_admin = is_super_admin(message.from_user.id)
         await message.answer("Панель администратора:", reply_markup=admin_main_keyboard(super_admin))
         return
     try:
@@ -2181,7 +2504,7 @@ async def remove_balance_user(message: types.Message, state: FSMContext):
 async def remove_balance_amount(message: types.Message, state: FSMContext):
     if message.text == "◀️ Назад":
         await state.finish()
-        super_admin = await is_super_admin(message.from_user.id)
+        super_admin = is_super_admin(message.from_user.id)
         await message.answer("Панель администратора:", reply_markup=admin_main_keyboard(super_admin))
         return
     try:
@@ -2194,8 +2517,7 @@ async def remove_balance_amount(message: types.Message, state: FSMContext):
     data = await state.get_data()
     uid = data['user_id']
     try:
-        async with db_pool.acquire() as conn:
-            await conn.execute("UPDATE users SET balance = balance - $1 WHERE user_id=$2", amount, uid)
+        await update_user_balance(uid, -amount)
         await message.answer(f"✅ У пользователя {uid} списано {amount} монет.")
         safe_send_message_task(uid, f"💸 У тебя списано {amount} монет администратором.")
     except Exception as e:
@@ -2215,7 +2537,7 @@ async def add_balance_start(message: types.Message):
 async def add_balance_user(message: types.Message, state: FSMContext):
     if message.text == "◀️ Назад":
         await state.finish()
-        super_admin = await is_super_admin(message.from_user.id)
+        super_admin = is_super_admin(message.from_user.id)
         await message.answer("Панель администратора:", reply_markup=admin_main_keyboard(super_admin))
         return
     try:
@@ -2231,7 +2553,7 @@ async def add_balance_user(message: types.Message, state: FSMContext):
 async def add_balance_amount(message: types.Message, state: FSMContext):
     if message.text == "◀️ Назад":
         await state.finish()
-        super_admin = await is_super_admin(message.from_user.id)
+        super_admin = is_super_admin(message.from_user.id)
         await message.answer("Панель администратора:", reply_markup=admin_main_keyboard(super_admin))
         return
     try:
@@ -2244,8 +2566,7 @@ async def add_balance_amount(message: types.Message, state: FSMContext):
     data = await state.get_data()
     uid = data['user_id']
     try:
-        async with db_pool.acquire() as conn:
-            await conn.execute("UPDATE users SET balance = balance + $1 WHERE user_id=$2", amount, uid)
+        await update_user_balance(uid, amount)
         await message.answer(f"✅ Пользователю {uid} начислено {amount} монет.")
         safe_send_message_task(uid, f"💰 Вам начислено {amount} монет администратором.")
     except Exception as e:
@@ -2256,7 +2577,7 @@ async def add_balance_amount(message: types.Message, state: FSMContext):
 # ===== СБРОС СТАТИСТИКИ =====
 @dp.message_handler(lambda message: message.text == "🔄 Сброс статистики")
 async def reset_stats(message: types.Message):
-    if not await is_super_admin(message.from_user.id):
+    if not is_super_admin(message.from_user.id):
         return
     confirm_kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Да, сбросить всё", callback_data="reset_confirm")],
@@ -2266,10 +2587,10 @@ async def reset_stats(message: types.Message):
 
 @dp.callback_query_handler(lambda c: c.data == "reset_confirm")
 async def reset_confirm(callback: types.CallbackQuery):
-    if not await is_super_admin(callback.from_user.id):
+    if not is_super_admin(callback.from_user.id):
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await conn.execute("UPDATE users SET balance=0, theft_attempts=0, theft_success=0, theft_failed=0, theft_protected=0, last_theft_time=NULL")
             await conn.execute("DELETE FROM purchases")
         await callback.message.edit_text("✅ Статистика сброшена.")
@@ -2295,7 +2616,7 @@ async def broadcast_start(message: types.Message):
 async def broadcast_media(message: types.Message, state: FSMContext):
     if message.text == "◀️ Назад":
         await state.finish()
-        super_admin = await is_super_admin(message.from_user.id)
+        super_admin = is_super_admin(message.from_user.id)
         await message.answer("Панель администратора:", reply_markup=admin_main_keyboard(super_admin))
         return
 
@@ -2322,59 +2643,67 @@ async def broadcast_media(message: types.Message, state: FSMContext):
     await state.finish()
 
     status_msg = await message.answer("⏳ Рассылка начата... Это может занять некоторое время.")
+    sent, failed, total = await broadcast(content, status_msg)
+    await status_msg.edit_text(f"✅ Рассылка завершена!\n📊 Отправлено: {sent}\n❌ Ошибок: {failed}\n👥 Всего: {total}")
 
-    async with db_pool.acquire() as conn:
-        users = await conn.fetch("SELECT user_id FROM users")
-        users = [r['user_id'] for r in users]
-
-    sent = 0
-    failed = 0
-    total = len(users)
+# ID получателей читаются из БД пачками, внутри пачки сообщения уходят
+# параллельно, а общую скорость ограничивает GLOBAL_LIMIT
+SQL_BROADCAST_COUNT = (
+    "SELECT COUNT(*) FROM users u "
+    "WHERE NOT EXISTS (SELECT 1 FROM banned_users b WHERE b.user_id = u.user_id)"
+)
+SQL_BROADCAST_CHUNK = (
+    "SELECT u.user_id FROM users u "
+    "WHERE u.user_id > $1 AND NOT EXISTS (SELECT 1 FROM banned_users b WHERE b.user_id = u.user_id) "
+    "ORDER BY u.user_id LIMIT $2"
+)
+BROADCAST_CHUNK_SIZE = 100
 
-    for i, uid in enumerate(users):
-        if await is_banned(uid):
-            continue
+async def send_broadcast_content(uid: int, content: dict) -> bool:
+    for _ in range(2):
+        await wait_flood_pause()
         try:
-            if content['type'] == 'text':
-                await bot.send_message(uid, content['text'])
-            elif content['type'] == 'photo':
-                await bot.send_photo(uid, content['file_id'], caption=content['caption'])
-            elif content['type'] == 'video':
-                await bot.send_video(uid, content['file_id'], caption=content['caption'])
-            elif content['type'] == 'document':
-                await bot.send_document(uid, content['file_id'], caption=content['caption'])
-            sent += 1
+            async with get_chat_limiter(uid), GLOBAL_LIMIT:
+                if content['type'] == 'text':
+                    await bot.send_message(uid, content['text'])
+                elif content['type'] == 'photo':
+                    await bot.send_photo(uid, content['file_id'], caption=content['caption'])
+                elif content['type'] == 'video':
+                    await bot.send_video(uid, content['file_id'], caption=content['caption'])
+                elif content['type'] == 'document':
+                    await bot.send_document(uid, content['file_id'], caption=content['caption'])
+            return True
         except (BotBlocked, UserDeactivated, ChatNotFound):
-            failed += 1
+            return False
         except RetryAfter as e:
             logging.warning(f"Flood limit, waiting {e.timeout} seconds")
-            await asyncio.sleep(e.timeout)
-            try:
-                if content['type'] == 'text':
-                    await bot.send_message(uid, content['text'])
-                else:
-                    if content['type'] == 'photo':
-                        await bot.send_photo(uid, content['file_id'], caption=content['caption'])
-                    elif content['type'] == 'video':
-                        await bot.send_video(uid, content['file_id'], caption=content['caption'])
-                    elif content['type'] == 'document':
-                        await bot.send_document(uid, content['file_id'], caption=content['caption'])
-                sent += 1
-            except:
-                failed += 1
+            pause_sending(e.timeout)
         except Exception as e:
-            failed += 1
             logging.warning(f"Failed to send to {uid}: {e}")
+            return False
+    return False
 
-        if (i + 1) % 10 == 0:
-            try:
-                await status_msg.edit_text(f"⏳ Прогресс: {i+1}/{total}\n✅ Отправлено: {sent}\n❌ Ошибок: {failed}")
-            except:
-                pass
-
-        await asyncio.sleep(0.05)
-
-    await status_msg.edit_text(f"✅ Рассылка завершена!\n📊 Отправлено: {sent}\n❌ Ошибок: {failed}\n👥 Всего: {total}")
+async def broadcast(content: dict, status_msg: types.Message):
+    async with acquire_conn() as conn:
+        total = await conn.fetchval(SQL_BROADCAST_COUNT)
+    sent = 0
+    failed = 0
+    last_id = 0
+    while True:
+        async with acquire_conn() as conn:
+            rows = await conn.fetch(SQL_BROADCAST_CHUNK, last_id, BROADCAST_CHUNK_SIZE)
+        if not rows:
+            break
+        last_id = rows[-1]['user_id']
+        results = await asyncio.gather(*[send_broadcast_content(r['user_id'], content) for r in rows])
+        ok_count = sum(results)
+        sent += ok_count
+        failed += len(results) - ok_count
+        try:
+            await status_msg.edit_text(f"⏳ Прогресс: {sent + failed}/{total}\n✅ Отправлено: {sent}\n❌ Ошибок: {failed}")
+        except:
+            pass
+    return sent, failed, total
 
 # ===== НАЗАД В ГЛАВНОЕ МЕНЮ =====
 @dp.message_handler(lambda message: message.text == "◀️ Назад в главное меню")
@@ -2390,63 +2719,153 @@ async def back_from_submenu(message: types.Message):
 # ===== ОБРАБОТКА НЕИЗВЕСТНЫХ СООБЩЕНИЙ =====
 @dp.message_handler()
 async def unknown_message(message: types.Message):
-    if await is_banned(message.from_user.id) and not await is_admin(message.from_user.id):
+    admin_flag, banned = await get_user_flags(message.from_user.id)
+    if banned and not admin_flag:
         return
-    admin_flag = await is_admin(message.from_user.id)
     await message.answer("Я не понимаю эту команду. Используй кнопки меню.", reply_markup=user_main_keyboard(admin_flag))
 
 # ===== ВЕБ-СЕРВЕР =====
 async def handle(request):
     return web.Response(text="Bot is running")
 
-async def start_web_server():
-    app = web.Application()
+@web.middleware
+async def webhook_secret_middleware(request, handler):
+    if WEBHOOK_URL and request.path == WEBHOOK_PATH:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, WEBHOOK_SECRET):
+            logging.warning(f"Webhook request with invalid secret from {request.remote}")
+            raise web.HTTPForbidden()
+    return await handler(request)
+
+def create_web_app():
+    app = web.Application(middlewares=[webhook_secret_middleware])
     app.router.add_get("/", handle)
-    runner = web.AppRunner(app)
-    await runner.setup()
-    port = int(os.environ.get("PORT", 8080))
-    site = web.TCPSite(runner, "0.0.0.0", port)
+    return app
+
+async def start_web_server():
+    global web_runner
+    web_runner = web.AppRunner(create_web_app())
+    await web_runner.setup()
+    site = web.TCPSite(web_runner, "0.0.0.0", WEB_PORT)
     await site.start()
-    logging.info(f"Web server started on port {port}")
+    logging.info(f"Web server started on port {WEB_PORT}")
 
 # ===== ФОНОВЫЕ ЗАДАЧИ =====
+# Задача спит до ближайшего окончания активного розыгрыша (но не дольше
+# GIVEAWAY_CHECK_MAX_SLEEP) и просыпается раньше, если создан новый розыгрыш:
+# в этом процессе – через giveaways_changed, в других воркерах – через NOTIFY
+GIVEAWAY_CHECK_MAX_SLEEP = 600
+GIVEAWAY_CHANNEL = "giveaway_created"
+giveaways_changed = asyncio.Event()
+
+async def notify_giveaways_changed(conn):
+    giveaways_changed.set()
+    await conn.execute(f"NOTIFY {GIVEAWAY_CHANNEL}")
+
 async def check_expired_giveaways():
     while True:
-        await asyncio.sleep(600)
+        giveaways_changed.clear()
+        delay = None
         try:
-            async with db_pool.acquire() as conn:
-                now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                await conn.execute("UPDATE giveaways SET status='completed' WHERE status='active' AND end_date < $1", now)
+            async with acquire_conn() as conn:
+                await conn.execute("UPDATE giveaways SET status='completed' WHERE status='active' AND end_date < now()")
+                delay = await conn.fetchval(
+                    "SELECT EXTRACT(EPOCH FROM MIN(end_date) - now())::float8 FROM giveaways WHERE status='active'"
+                )
         except Exception as e:
             logging.error(f"Expired giveaways check error: {e}")
+        timeout = GIVEAWAY_CHECK_MAX_SLEEP if delay is None else min(max(1, delay), GIVEAWAY_CHECK_MAX_SLEEP)
+        try:
+            await asyncio.wait_for(giveaways_changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+def on_settings_notify(conn, pid, channel, payload):
+    SETTINGS_CACHE.update(json.loads(payload))
+
+# LISTEN на выделенном соединении: новые розыгрыши и изменения настроек с других воркеров.
+# Если соединение оборвалось, слушатель переподключается и перечитывает настройки,
+# пропущенные за время разрыва. Через PgBouncer в режиме transaction LISTEN
+# не работает (DB_PGBOUNCER), тогда воркеры полагаются на ограниченный сон
+# и refresh_settings_cache
+DB_LISTENER_RETRY_SECONDS = 5
+
+async def db_listener():
+    on_giveaway = lambda *args: giveaways_changed.set()
+    while True:
+        lost = asyncio.Event()
+        listener_conn = None
+        try:
+            listener_conn = await db_pool.acquire()
+            listener_conn.add_termination_listener(lambda *args: lost.set())
+            await listener_conn.add_listener(GIVEAWAY_CHANNEL, on_giveaway)
+            await listener_conn.add_listener(SETTINGS_CHANNEL, on_settings_notify)
+            # Настройки и розыгрыши могли измениться, пока слушатель не был подключён
+            await load_settings(listener_conn)
+            giveaways_changed.set()
+            await lost.wait()
+            logging.warning("DB listener connection lost, reconnecting")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"DB listener error: {e}")
+        finally:
+            if listener_conn is not None:
+                try:
+                    if not listener_conn.is_closed():
+                        await listener_conn.remove_listener(GIVEAWAY_CHANNEL, on_giveaway)
+                        await listener_conn.remove_listener(SETTINGS_CHANNEL, on_settings_notify)
+                    await db_pool.release(listener_conn)
+                except Exception as e:
+                    logging.warning(f"DB listener cleanup error: {e}")
+        await asyncio.sleep(DB_LISTENER_RETRY_SECONDS)
+
+async def refresh_settings_cache():
+    while True:
+        await asyncio.sleep(SETTINGS_CACHE_TTL)
+        try:
+            async with acquire_conn() as conn:
+                await load_settings(conn)
+        except Exception as e:
+            logging.error(f"Settings refresh error: {e}")
 
 # ===== ЗАПУСК =====
 async def on_startup(dp):
     await before_start()
     await create_db_pool()
     await init_db()
-    asyncio.create_task(check_expired_giveaways())
-    asyncio.create_task(start_web_server())
+    background_tasks.append(asyncio.create_task(check_expired_giveaways()))
+    if DB_PGBOUNCER:
+        background_tasks.append(asyncio.create_task(refresh_settings_cache()))
+    else:
+        background_tasks.append(asyncio.create_task(db_listener()))
+    background_tasks.append(asyncio.create_task(cleanup_chat_limiters()))
+    if not WEBHOOK_URL:
+        # В режиме вебхука сервер поднимает executor на том же приложении
+        await start_web_server()
     logging.info("🤖 Бот запущен и готов к работе!")
     logging.info(f"👑 Суперадмины: {SUPER_ADMINS}")
     logging.info(f"🗄 База данных: PostgreSQL")
 
 async def on_shutdown(dp):
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    if web_runner:
+        await web_runner.cleanup()
     await db_pool.close()
-    await storage.close()
     await dp.storage.close()
-    await bot.close()
+    await (await bot.get_session()).close()
     logging.info("Бот остановлен")
 
 if __name__ == "__main__":
-    while True:
-        try:
-            executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
-        except TerminatedByOtherGetUpdates:
-            logging.error("Конфликт с другим экземпляром. Жду 5 сек...")
-            time.sleep(5)
-            continue
-        except Exception as e:
-            logging.error(f"Критическая ошибка: {e}")
-            time.sleep(5)
-            continue
+    if WEBHOOK_URL:
+        webhook_executor = executor.set_webhook(
+            dp, WEBHOOK_PATH, on_startup=on_startup, on_shutdown=on_shutdown,
+            check_ip=WEBHOOK_CHECK_IP, web_app=create_web_app()
+        )
+        webhook_executor.run_app(host="0.0.0.0", port=WEB_PORT)
+    else:
+        # Перезапуск после падения – забота платформы (политика рестарта Railway/systemd)
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)